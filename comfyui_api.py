@@ -1,15 +1,32 @@
 import aiohttp
 import asyncio
+import json
 import random
+import struct
+import time
 from typing import Optional
+from astrbot.api import logger
 
 
 class ComfyUIAPI:
+    # websocket 二进制帧类型，见 ComfyUI server.BinaryEventTypes
+    WS_PREVIEW_IMAGE = 1
+    # 后台刷新 /object_info 的间隔（秒）
+    OBJECT_INFO_REFRESH = 3600
+
     def __init__(self, server_url: str = "http://127.0.0.1:8188", timeout: int = 300):
         self.server_url = server_url
         self.timeout = timeout
         self.client_id = str(random.randint(100000, 999999))
 
+        self._ws_task = None
+        self._ws_ready = asyncio.Event()
+        self._ws_connected = False
+        self._ws_current = (None, None)  # 当前执行中的 (prompt_id, node_id)
+        self._ws_jobs = {}  # {prompt_id: {"images": [(node_id, bytes)], "done": Future, "created": float}}
+        self._upload_cache = {}  # {内容哈希: 服务端文件名}
+        self.object_info = None  # 缓存的节点定义，由后台任务刷新
+
     async def queue_prompt(self, workflow: dict) -> Optional[str]:
         """提交任务，返回 prompt_id"""
         async with aiohttp.ClientSession() as session:
@@ -28,6 +45,68 @@ class ComfyUIAPI:
                         logger.error(f"[ComfyUI] 提交任务失败，状态码: {resp.status}")
         return None
 
+    async def refresh_object_info(self) -> Optional[dict]:
+        """重新获取节点定义并缓存；失败时保留上一次的缓存（可能为 None）"""
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{self.server_url}/object_info") as resp:
+                    if resp.status == 200:
+                        body = await resp.read()
+                        # 节点定义可达数 MB，放到线程中解析以免阻塞事件循环
+                        self.object_info = await asyncio.to_thread(json.loads, body)
+                    else:
+                        logger.error(f"[ComfyUI] 获取节点定义失败，状态码: {resp.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.error(f"[ComfyUI] 获取节点定义失败: {e}")
+        return self.object_info
+
+    def get_cached_upload(self, key: str) -> Optional[str]:
+        """查询该图片是否已上传到此后端，返回服务端文件名"""
+        return self._upload_cache.get(key)
+
+    def forget_upload(self, key: str):
+        self._upload_cache.pop(key, None)
+
+    async def upload_image(self, data: bytes, key: str, ext: str = "png") -> Optional[str]:
+        """上传输入图片，返回可填入 LoadImage 节点的文件名"""
+        content_type = "image/jpeg" if ext == "jpg" else f"image/{ext}"
+        form = aiohttp.FormData()
+        form.add_field("image", data, filename=f"astrbot_{key}.{ext}", content_type=content_type)
+        form.add_field("overwrite", "true")
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f"{self.server_url}/upload/image", data=form) as resp:
+                    if resp.status != 200:
+                        logger.error(f"[ComfyUI] 上传图片失败，状态码: {resp.status}, 详情: {await resp.text()}")
+                        return None
+                    result = await resp.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"[ComfyUI] 上传图片失败: {e}")
+            return None
+
+        name = result.get("name")
+        if not name:
+            return None
+        if result.get("subfolder"):
+            name = f"{result['subfolder']}/{name}"
+        self._upload_cache[key] = name
+        return name
+
+    async def wait_done(self, prompt_id: str) -> bool:
+        """等待任务执行完毕，不下载结果"""
+        async with aiohttp.ClientSession() as session:
+            for _ in range(self.timeout):
+                await asyncio.sleep(1)
+                try:
+                    async with session.get(f"{self.server_url}/history/{prompt_id}") as resp:
+                        if resp.status == 200:
+                            history = await resp.json()
+                            if prompt_id in history:
+                                return history[prompt_id].get("status", {}).get("status_str") != "error"
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    continue
+        return False
+
     async def wait_result(self, prompt_id: str) -> Optional[bytes]:
         """等待并下载结果"""
         async with aiohttp.ClientSession() as session:
@@ -49,3 +128,130 @@ class ComfyUIAPI:
                 except (aiohttp.ClientError, asyncio.TimeoutError, KeyError):
                     continue
         return None
+
+    async def connect_ws(self) -> bool:
+        """建立共享 websocket 连接，返回连接是否可用"""
+        if self._ws_task is None or self._ws_task.done():
+            self._ws_ready = asyncio.Event()
+            self._ws_task = asyncio.create_task(self._ws_loop())
+        try:
+            await asyncio.wait_for(self._ws_ready.wait(), 10)
+        except asyncio.TimeoutError:
+            return False
+        return self._ws_connected
+
+    async def close(self):
+        """关闭 websocket 连接"""
+        if self._ws_task and not self._ws_task.done():
+            self._ws_task.cancel()
+        self._ws_task = None
+
+    async def _ws_loop(self):
+        """维持共享 websocket 连接，断线后按退避时间重连，等待中的任务保留到各自超时"""
+        ws_url = self.server_url.replace("http", "ws", 1) + f"/ws?clientId={self.client_id}"
+        backoff = 1
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(ws_url, max_msg_size=0) as ws:
+                        self._ws_connected = True
+                        self._ws_ready.set()
+                        backoff = 1
+                        reconcile = asyncio.create_task(self._reconcile_ws_jobs())
+                        try:
+                            async for msg in ws:
+                                if msg.type == aiohttp.WSMsgType.TEXT:
+                                    self._handle_ws_message(json.loads(msg.data))
+                                elif msg.type == aiohttp.WSMsgType.BINARY:
+                                    self._handle_ws_binary(msg.data)
+                        finally:
+                            reconcile.cancel()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.error(f"[ComfyUI] websocket 连接异常: {e}")
+
+            self._ws_connected = False
+            self._ws_current = (None, None)
+            self._ws_ready.set()
+            logger.info(f"[ComfyUI] websocket 已断开，{backoff} 秒后重连")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    async def _reconcile_ws_jobs(self):
+        """重连后检查等待中的任务：若已在断线期间完成，其图片帧已丢失，直接判为失败"""
+        pending = [k for k, v in self._ws_jobs.items() if not v["done"].done()]
+        if not pending:
+            return
+        async with aiohttp.ClientSession() as session:
+            for prompt_id in pending:
+                try:
+                    async with session.get(f"{self.server_url}/history/{prompt_id}") as resp:
+                        if resp.status == 200 and prompt_id in await resp.json():
+                            logger.error(f"[ComfyUI] 任务 {prompt_id} 在 websocket 断线期间完成，结果已丢失")
+                            self._finish_ws_job(prompt_id, False)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    continue
+
+    def _ws_job(self, prompt_id: str) -> dict:
+        if prompt_id not in self._ws_jobs:
+            # 清理无人认领的过期任务
+            now = time.time()
+            for stale_id in [k for k, v in self._ws_jobs.items() if now - v["created"] > self.timeout * 2]:
+                del self._ws_jobs[stale_id]
+            self._ws_jobs[prompt_id] = {
+                "images": [],
+                "done": asyncio.get_running_loop().create_future(),
+                "created": now
+            }
+        return self._ws_jobs[prompt_id]
+
+    def _finish_ws_job(self, prompt_id: str, success: bool):
+        if not prompt_id:
+            return
+        done = self._ws_job(prompt_id)["done"]
+        if not done.done():
+            done.set_result(success)
+
+    def _handle_ws_message(self, message: dict):
+        msg_type = message.get("type")
+        data = message.get("data") or {}
+        if msg_type == "executing":
+            prompt_id = data.get("prompt_id")
+            if data.get("node") is None:
+                # node 为空表示该任务已执行完毕
+                self._finish_ws_job(prompt_id, True)
+                self._ws_current = (None, None)
+            else:
+                self._ws_current = (prompt_id, data.get("node"))
+        elif msg_type == "execution_error":
+            logger.error(f"[ComfyUI] 任务执行出错: {data.get('exception_message', '')}")
+            self._finish_ws_job(data.get("prompt_id"), False)
+        elif msg_type == "execution_interrupted":
+            logger.error(f"[ComfyUI] 任务被中断: {data.get('prompt_id')}")
+            self._finish_ws_job(data.get("prompt_id"), False)
+
+    def _handle_ws_binary(self, data: bytes):
+        prompt_id, node_id = self._ws_current
+        if not prompt_id or len(data) <= 8:
+            return
+        # 帧格式：4 字节事件类型 + 4 字节图片格式 + 图片数据
+        event_type = struct.unpack(">I", data[:4])[0]
+        if event_type == self.WS_PREVIEW_IMAGE:
+            self._ws_job(prompt_id)["images"].append((node_id, data[8:]))
+
+    async def wait_ws_result(self, prompt_id: str, output_nodes: list) -> Optional[bytes]:
+        """等待 websocket 输出节点推送的图片"""
+        job = self._ws_job(prompt_id)
+        try:
+            success = await asyncio.wait_for(job["done"], self.timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._ws_jobs.pop(prompt_id, None)
+
+        if not success:
+            return None
+        # 采样预览也会以同类帧推送，只取输出节点的图片
+        for node_id, image in job["images"]:
+            if node_id in output_nodes:
+                return image
+        return None
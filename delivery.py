@@ -0,0 +1,85 @@
+import time
+import uuid
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+from PIL import Image as PILImage
+from astrbot.api import logger
+from astrbot.api.message_components import Image
+
+
+class ImageDelivery:
+    # Discord 和 Telegram 的默认文件大小限制
+    SIZE_LIMITED_PLATFORMS = ["discord", "telegram"]
+    MAX_SIZE = 10 * 1024 * 1024
+
+    def __init__(self, temp_dir: Path, inline_platforms: list = None):
+        self.temp_dir = temp_dir
+        self.inline_platforms = set(inline_platforms if inline_platforms is not None else ["aiocqhttp"])
+
+    def make_image(self, platform: str, data: bytes, ext: str = "png") -> Image:
+        """构建图片消息段：支持的平台直接内联 base64，其余平台写入临时文件"""
+        if platform in self.inline_platforms:
+            return Image.fromBytes(data)
+
+        temp_file = self.temp_dir / f"{int(time.time())}_{uuid.uuid4().hex[:8]}.{ext}"
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        return Image.fromFileSystem(str(temp_file))
+
+    def fit_size_limit(self, platform: str, data: bytes) -> tuple:
+        """超出平台大小限制时尝试压缩，返回 (图片数据, 扩展名, 警告信息)"""
+        if platform not in self.SIZE_LIMITED_PLATFORMS or len(data) <= self.MAX_SIZE:
+            return data, "png", None
+
+        size_mb = len(data) / (1024 * 1024)
+        logger.info(f"图片大小 {size_mb:.1f}MB 超过限制，尝试压缩...")
+
+        try:
+            img = PILImage.open(BytesIO(data))
+
+            # 先尝试WebP（质量90）
+            webp_data = self._encode(img, 'WEBP', 90)
+            if len(webp_data) <= self.MAX_SIZE:
+                logger.info(f"成功转换为WebP格式，大小: {len(webp_data) / (1024 * 1024):.1f}MB")
+                return webp_data, "webp", None
+
+            # WebP仍然太大，尝试AVIF（质量85）
+            try:
+                avif_data = self._encode(img, 'AVIF', 85)
+                if len(avif_data) <= self.MAX_SIZE:
+                    logger.info(f"成功转换为AVIF格式，大小: {len(avif_data) / (1024 * 1024):.1f}MB")
+                    return avif_data, "avif", None
+            except Exception as e:
+                logger.error(f"AVIF转换失败: {e}，使用WebP")
+
+            # 还是太大，尝试降低WebP质量
+            for quality in [80, 70, 60, 50]:
+                webp_data = self._encode(img, 'WEBP', quality)
+                if len(webp_data) <= self.MAX_SIZE:
+                    logger.info(f"使用WebP质量{quality}压缩成功，大小: {len(webp_data) / (1024 * 1024):.1f}MB")
+                    return webp_data, "webp", None
+
+            return data, "png", f"⚠️ 警告：原图 {size_mb:.1f}MB，压缩后仍超过 10MB 限制，可能无法发送"
+        except Exception as e:
+            logger.error(f"图片压缩失败: {e}")
+            return data, "png", f"⚠️ 警告：生成的图片为 {size_mb:.1f}MB，超过平台默认 10MB 限制，压缩失败"
+
+    @staticmethod
+    def _encode(img: PILImage.Image, fmt: str, quality: int) -> bytes:
+        buffer = BytesIO()
+        img.save(buffer, format=fmt, quality=quality)
+        return buffer.getvalue()
+
+    @staticmethod
+    def extract_message_id(result) -> Optional[str]:
+        """从 call_action 的返回值中提取消息ID，兼容多种返回结构"""
+        if isinstance(result, dict):
+            data = result.get('data')
+            if data:
+                return data.get('message_id') if isinstance(data, dict) else data
+            if 'message_id' in result:
+                return result['message_id']
+        elif isinstance(result, (int, str)):
+            return str(result)
+        return None
@@ -4,14 +4,17 @@ from astrbot.api.star import Context, Star, register
 from astrbot.api import AstrBotConfig, logger
 from astrbot.api.message_components import Node, Image, Reply
 from pathlib import Path
+import asyncio
+import base64
 import shutil
 import time
 import re
 import json
-from io import BytesIO
-from PIL import Image as PILImage
 from .comfyui_api import ComfyUIAPI
 from .text_to_image import TextToImage
+from .resolution_policy import ResolutionPolicy
+from .delivery import ImageDelivery
+from .profiler import PipelineProfiler
 
 
 @register("astrbot_plugin_comfyui_hub", "ChooseC", "为 AstrBot 提供 ComfyUI 调用能力的插件，计划支持 ComfyUI 全功能。",
@@ -35,11 +38,13 @@ class ComfyUIHub(Star):
 
         self.temp_dir = data_dir / "temp"
         self.temp_dir.mkdir(exist_ok=True)
+        self.delivery = ImageDelivery(self.temp_dir, config.get("inline_image_platforms", ["aiocqhttp"]))
 
         self.block_tags_file = data_dir / "block_tags.json"
         self.blocked_users_file = data_dir / "blocked_users.json"
         self.censorship_config_file = data_dir / "censorship_config.json"
         self.sent_messages_file = data_dir / "sent_messages.json"
+        self.profiler = PipelineProfiler(data_dir / "profiles", config.get("profile_lag_threshold_ms", 100) / 1000)
         self._load_block_data()
 
         workflow_filename = config.get("txt2img_workflow", "example_text2img.json")
@@ -64,7 +69,17 @@ class ComfyUIHub(Star):
             config.get("resolution_width_field", "width"),
             config.get("resolution_height_field", "height"),
             config.get("upscale_node", ""),
-            config.get("upscale_scale_field", "resize_scale")
+            config.get("upscale_scale_field", "resize_scale"),
+            ResolutionPolicy(
+                config.get("max_pixels", 4194304),
+                config.get("max_upscale", 4.0),
+                config.get("snap_resolution_buckets", False),
+                config.get("upscale_oversized", False),
+                config.get("group_resolution_limits", [])
+            ),
+            config.get("websocket_output", False),
+            config.get("image_input_node", ""),
+            config.get("image_input_field", "image")
         )
 
         # 初始化审查设置
@@ -73,6 +88,85 @@ class ComfyUIHub(Star):
         self.llm_provider_id = config.get("llm_provider_id", "")
         self.admin_bypass_censorship = config.get("admin_bypass_censorship", True)
 
+        # 预热与保活设置
+        self.warmup_on_load = config.get("warmup_on_load", False)
+        self.keep_alive_interval = config.get("keep_alive_interval", 0)
+        self.last_activity = time.time()
+        self.active_jobs = 0
+        self._background_tasks = set()
+        self._object_info_refresh = None
+
+    async def initialize(self):
+        self._background_tasks.add(asyncio.create_task(self._startup()))
+        if self.keep_alive_interval > 0:
+            self._background_tasks.add(asyncio.create_task(self._keep_alive_loop()))
+
+    async def terminate(self):
+        for task in self._background_tasks:
+            task.cancel()
+        self._background_tasks.clear()
+        await self.api.close()
+
+    async def _startup(self):
+        """加载时校验工作流，按配置预热模型，之后在后台定期刷新节点定义"""
+        errors = await self._refresh_object_info()
+        if self.warmup_on_load and not errors:
+            await self._warmup()
+
+        # 绘图时只读取缓存的节点定义；尚未获取成功或校验有误时缩短重试间隔，
+        # 以便在 ComfyUI 安装缺失节点并重启后尽快恢复
+        while True:
+            if self.api.object_info is None or self.txt2img.validation_errors:
+                await asyncio.sleep(60)
+            else:
+                await asyncio.sleep(self.api.OBJECT_INFO_REFRESH)
+            await self._refresh_object_info()
+
+    async def _refresh_object_info(self) -> list:
+        """重新获取节点定义并校验工作流，返回错误信息列表"""
+        try:
+            await self.api.refresh_object_info()
+            return self.txt2img.validate()
+        except Exception as e:
+            logger.error(f"[ComfyUI] 工作流校验出错: {e}")
+            return [str(e)]
+
+    def _schedule_object_info_refresh(self):
+        """在后台刷新节点定义，同一时间只保留一个刷新任务"""
+        if self._object_info_refresh and not self._object_info_refresh.done():
+            return
+        self._object_info_refresh = asyncio.create_task(self._refresh_object_info())
+        self._background_tasks.add(self._object_info_refresh)
+        self._object_info_refresh.add_done_callback(self._background_tasks.discard)
+
+    async def _run_profile(self, event: AstrMessageEvent, seconds: int):
+        """后台采集性能数据，结束后将报告路径发回会话"""
+        try:
+            report_path = await self.profiler.capture(seconds)
+            message = f"✅ 性能采集完成，报告已保存到: {report_path}"
+        except Exception as e:
+            logger.error(f"性能采集失败: {e}")
+            message = f"❌ 性能采集失败: {e}"
+        await self.context.send_message(event.unified_msg_origin, MessageChain().message(message))
+
+    async def _warmup(self):
+        """提交一次极小的工作流，让 ComfyUI 提前加载模型"""
+        start = time.time()
+        try:
+            if await self.txt2img.warmup():
+                logger.info(f"[ComfyUI] 预热完成，耗时 {time.time() - start:.1f} 秒")
+        except Exception as e:
+            logger.error(f"[ComfyUI] 预热失败: {e}")
+
+    async def _keep_alive_loop(self):
+        """空闲超过保活间隔时发送预热任务，避免模型被卸载"""
+        while True:
+            await asyncio.sleep(self.keep_alive_interval)
+            if self.active_jobs or time.time() - self.last_activity < self.keep_alive_interval:
+                continue
+            await self._warmup()
+            self.last_activity = time.time()
+
     def _load_block_data(self):
         self.block_tags = set()
         self.blocked_users = {}
@@ -185,6 +279,32 @@ class ComfyUIHub(Star):
             # 失败默认放行，避免服务不可用
             return True, f"审查出错: {e}"
 
+    async def _send_status_message(self, event: AstrMessageEvent, group_id: str):
+        """发送"正在生成图片..."提示，返回消息ID"""
+        try:
+            result = await event.bot.api.call_action(
+                "send_group_msg",
+                group_id=int(group_id),
+                message="正在生成图片..."
+            )
+            return self.delivery.extract_message_id(result)
+        except Exception as e:
+            logger.error(f"发送文字消息失败: {e}")
+            return None
+
+    async def _get_input_image(self, event: AstrMessageEvent):
+        """获取消息或被引用消息中的第一张图片"""
+        for seg in event.get_messages():
+            candidates = (seg.chain or []) if isinstance(seg, Reply) else [seg]
+            for comp in candidates:
+                if isinstance(comp, Image):
+                    try:
+                        return base64.b64decode(await comp.convert_to_base64())
+                    except Exception as e:
+                        logger.error(f"获取输入图片失败: {e}")
+                        return None
+        return None
+
     def _parse_params(self, text: str) -> tuple:
         """解析用户输入的参数"""
         params = {
@@ -311,6 +431,23 @@ class ComfyUIHub(Star):
                 yield event.plain_result(f"✅ 已在当前群组关闭审查功能。")
                 return
             
+            if text.startswith('$profile'):
+                arg = text[len('$profile'):].strip()
+                if not arg.isdigit() or not 1 <= int(arg) <= 600:
+                    yield event.plain_result("用法: #draw $profile <秒数>，范围 1-600")
+                    return
+                if self.profiler.running:
+                    yield event.plain_result("⚠️ 已有性能采集正在进行。")
+                    return
+
+                seconds = int(arg)
+                task = asyncio.create_task(self._run_profile(event, seconds))
+                self._background_tasks.add(task)
+                # 使用 discard：terminate() 清空集合后，被取消的任务结束时回调不会报错
+                task.add_done_callback(self._background_tasks.discard)
+                yield event.plain_result(f"✅ 开始采集 {seconds} 秒的性能数据，完成后将发送报告路径。")
+                return
+
             if text.startswith('$add_block_tag'):
                 tags_part = text[len('$add_block_tag'):].strip()
                 raw_tags = re.split(r',|\[|\]', tags_part)
@@ -393,111 +530,49 @@ class ComfyUIHub(Star):
             yield event.plain_result("请输入正面提示词")
             return
 
-        # 发送"正在生成图片..."消息（使用 API 以获取消息ID）
-        text_msg_id = None
+        # 工作流配置错误时直接提示，不提交任务
+        errors = self.txt2img.validate()
+        if errors:
+            # 后台重新校验，不阻塞本次回复；修复后下一次绘图即可恢复
+            self._schedule_object_info_refresh()
+            yield event.plain_result("❌ 工作流配置有误：\n" + "\n".join(errors))
+            return
+
+        input_image = None
+        if self.txt2img.image_node:
+            input_image = await self._get_input_image(event)
+            if input_image is None:
+                yield event.plain_result("❌ 当前工作流需要输入图片，请在指令中附带或引用一张图片。")
+                return
+
+        # 发送"正在生成图片..."消息（使用 API 以获取消息ID），与生成任务并行进行
         group_id = event.get_group_id()
-        is_aiocqhttp = event.get_platform_name() == "aiocqhttp"
+        platform = event.get_platform_name()
+        is_aiocqhttp = platform == "aiocqhttp"
 
+        status_task = None
         if is_aiocqhttp and group_id:
-            try:
-                client = event.bot
-                result = await client.api.call_action(
-                    "send_group_msg",
-                    group_id=int(group_id),
-                    message="正在生成图片..."
-                )
-                if result:
-                    # 尝试多种可能的返回结构
-                    if isinstance(result, dict):
-                        if 'data' in result and result['data']:
-                            text_msg_id = result['data'].get('message_id')
-                        elif 'message_id' in result:
-                            text_msg_id = result['message_id']
-                        elif 'retcode' in result and result['retcode'] == 0:
-                            text_msg_id = result.get('data', {}).get('message_id')
-                    elif isinstance(result, (int, str)):
-                        text_msg_id = str(result)
-            except Exception as e:
-                logger.error(f"发送文字消息失败: {e}")
+            status_task = asyncio.create_task(self._send_status_message(event, group_id))
+
+        self.last_activity = time.time()
+        self.active_jobs += 1
+        try:
+            image_data = await self.txt2img.generate(positive, negative, width, height, scale, group_id, input_image)
+        finally:
+            self.active_jobs -= 1
+            self.last_activity = time.time()
 
-        image_data = await self.txt2img.generate(positive, negative, width, height, scale)
+        text_msg_id = await status_task if status_task else None
 
         if image_data:
-            temp_file = self.temp_dir / f"{int(time.time())}.png"
-            with open(temp_file, "wb") as f:
-                f.write(image_data)
-
-            # 检查文件大小限制（Discord 和 Telegram 都是 10MB）
-            if event.get_platform_name() in ["discord", "telegram"]:
-                file_size = len(image_data)
-                max_size = 10 * 1024 * 1024  # 10MB
-                
-                if file_size > max_size:
-                    size_mb = file_size / (1024 * 1024)
-                    logger.info(f"图片大小 {size_mb:.1f}MB 超过限制，尝试压缩...")
-                    
-                    # 尝试转换为WebP格式
-                    try:
-                        img = PILImage.open(BytesIO(image_data))
-                        
-                        # 先尝试WebP（质量90）
-                        webp_buffer = BytesIO()
-                        img.save(webp_buffer, format='WEBP', quality=90)
-                        webp_size = webp_buffer.tell()
-                        
-                        if webp_size <= max_size:
-                            temp_file = self.temp_dir / f"{int(time.time())}.webp"
-                            with open(temp_file, "wb") as f:
-                                f.write(webp_buffer.getvalue())
-                            webp_size_mb = webp_size / (1024 * 1024)
-                            logger.info(f"成功转换为WebP格式，大小: {webp_size_mb:.1f}MB")
-                        else:
-                            # WebP仍然太大，尝试AVIF（质量85）
-                            try:
-                                avif_buffer = BytesIO()
-                                img.save(avif_buffer, format='AVIF', quality=85)
-                                avif_size = avif_buffer.tell()
-                                
-                                if avif_size <= max_size:
-                                    temp_file = self.temp_dir / f"{int(time.time())}.avif"
-                                    with open(temp_file, "wb") as f:
-                                        f.write(avif_buffer.getvalue())
-                                    avif_size_mb = avif_size / (1024 * 1024)
-                                    logger.info(f"成功转换为AVIF格式，大小: {avif_size_mb:.1f}MB")
-                                else:
-                                    # 还是太大，尝试降低WebP质量
-                                    for quality in [80, 70, 60, 50]:
-                                        webp_buffer = BytesIO()
-                                        img.save(webp_buffer, format='WEBP', quality=quality)
-                                        if webp_buffer.tell() <= max_size:
-                                            temp_file = self.temp_dir / f"{int(time.time())}.webp"
-                                            with open(temp_file, "wb") as f:
-                                                f.write(webp_buffer.getvalue())
-                                            final_size_mb = webp_buffer.tell() / (1024 * 1024)
-                                            logger.info(f"使用WebP质量{quality}压缩成功，大小: {final_size_mb:.1f}MB")
-                                            break
-                                    else:
-                                        # 所有尝试都失败
-                                        yield event.plain_result(f"⚠️ 警告：原图 {size_mb:.1f}MB，压缩后仍超过 10MB 限制，可能无法发送")
-                            except Exception as e:
-                                logger.error(f"AVIF转换失败: {e}，使用WebP")
-                                # AVIF失败，继续尝试降低WebP质量
-                                for quality in [80, 70, 60, 50]:
-                                    webp_buffer = BytesIO()
-                                    img.save(webp_buffer, format='WEBP', quality=quality)
-                                    if webp_buffer.tell() <= max_size:
-                                        temp_file = self.temp_dir / f"{int(time.time())}.webp"
-                                        with open(temp_file, "wb") as f:
-                                            f.write(webp_buffer.getvalue())
-                                        final_size_mb = webp_buffer.tell() / (1024 * 1024)
-                                        logger.info(f"使用WebP质量{quality}压缩成功，大小: {final_size_mb:.1f}MB")
-                                        break
-                                else:
-                                    yield event.plain_result(f"⚠️ 警告：原图 {size_mb:.1f}MB，压缩后仍超过 10MB 限制，可能无法发送")
-                    except Exception as e:
-                        logger.error(f"图片压缩失败: {e}")
-                        yield event.plain_result(f"⚠️ 警告：生成的图片为 {size_mb:.1f}MB，超过平台默认 10MB 限制，压缩失败")
+            # 压缩为 CPU 密集操作，放到线程中执行以免阻塞事件循环
+            image_data, ext, warning = await asyncio.to_thread(
+                self.delivery.fit_size_limit, platform, image_data
+            )
+            if warning:
+                yield event.plain_result(warning)
 
+            image = self.delivery.make_image(platform, image_data, ext)
             sent_msg_id = None
 
             if is_aiocqhttp and group_id:
@@ -510,7 +585,7 @@ class ComfyUIHub(Star):
                         node = Node(
                             uin=event.get_sender_id(),
                             name="ComfyUI",
-                            content=[Image.fromFileSystem(str(temp_file))]
+                            content=[image]
                         )
                         # 使用 send_group_forward_msg 发送合并转发
                         result = await client.api.call_action(
@@ -518,46 +593,24 @@ class ComfyUIHub(Star):
                             group_id=int(group_id),
                             messages=[node]
                         )
-                        if result:
-                            # 尝试多种可能的返回结构
-                            if isinstance(result, dict):
-                                if 'data' in result and result['data']:
-                                    sent_msg_id = result['data'].get('message_id') if isinstance(result['data'], dict) else result['data']
-                                elif 'message_id' in result:
-                                    sent_msg_id = result['message_id']
-                            elif isinstance(result, (int, str)):
-                                sent_msg_id = str(result)
+                        sent_msg_id = self.delivery.extract_message_id(result)
                     except Exception as e:
                         logger.error(f"合并转发发送失败: {e}，改用普通图片发送")
                         # 失败则回退到普通图片发送
                         result = await client.api.call_action(
                             "send_group_msg",
                             group_id=int(group_id),
-                            message=[Image.fromFileSystem(str(temp_file))]
+                            message=[image]
                         )
-                        if result:
-                            if isinstance(result, dict):
-                                if 'data' in result and result['data']:
-                                    sent_msg_id = result['data'].get('message_id')
-                                elif 'message_id' in result:
-                                    sent_msg_id = result['message_id']
-                            elif isinstance(result, (int, str)):
-                                sent_msg_id = str(result)
+                        sent_msg_id = self.delivery.extract_message_id(result)
                 else:
                     # 普通图片消息
                     result = await client.api.call_action(
                         "send_group_msg",
                         group_id=int(group_id),
-                        message=[Image.fromFileSystem(str(temp_file))]
+                        message=[image]
                     )
-                    if result:
-                        if isinstance(result, dict):
-                            if 'data' in result and result['data']:
-                                sent_msg_id = result['data'].get('message_id')
-                            elif 'message_id' in result:
-                                sent_msg_id = result['message_id']
-                        elif isinstance(result, (int, str)):
-                            sent_msg_id = str(result)
+                    sent_msg_id = self.delivery.extract_message_id(result)
             else:
                 # 非 aiocqhttp 平台或私聊，使用默认方法
                 if chain:
@@ -565,13 +618,13 @@ class ComfyUIHub(Star):
                         node = Node(
                             uin=event.get_sender_id(),
                             name="ComfyUI",
-                            content=[Image.fromFileSystem(str(temp_file))]
+                            content=[image]
                         )
                         yield event.chain_result([node])
                     except Exception:
-                        yield event.image_result(str(temp_file))
+                        yield event.chain_result([image])
                 else:
-                    yield event.image_result(str(temp_file))
+                    yield event.chain_result([image])
 
             # 记录所有发送的消息ID（带时间戳）
             if group_id:
@@ -0,0 +1,114 @@
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from pathlib import Path
+from astrbot.api import logger
+
+
+class PipelineProfiler:
+    LAG_CHECK_INTERVAL = 0.05
+
+    def __init__(self, report_dir: Path, lag_threshold: float = 0.1):
+        self.report_dir = report_dir
+        self.lag_threshold = lag_threshold
+        self.running = False
+
+    async def _monitor_lag(self, lag_events: list, heartbeat: list):
+        """定时检测事件循环的调度延迟，超过阈值即记录"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            heartbeat[0] = time.monotonic()
+            await asyncio.sleep(self.LAG_CHECK_INTERVAL)
+            lag = loop.time() - start - self.LAG_CHECK_INTERVAL
+            if lag > self.lag_threshold:
+                lag_events.append((time.strftime("%H:%M:%S"), lag))
+                logger.warning(f"[ComfyUI] 事件循环阻塞 {lag * 1000:.0f}ms")
+
+    def _sample_blocked_stacks(self, loop_thread_id: int, heartbeat: list, stacks: list,
+                               stop: threading.Event):
+        """在独立线程中运行：事件循环超过阈值未响应时，采样事件循环线程的调用栈"""
+        sampled_beat = None
+        while not stop.wait(self.LAG_CHECK_INTERVAL):
+            beat = heartbeat[0]
+            if beat == sampled_beat or time.monotonic() - beat < self.LAG_CHECK_INTERVAL + self.lag_threshold:
+                continue
+            frame = sys._current_frames().get(loop_thread_id)
+            if frame is not None:
+                # 每次阻塞只采样一次
+                sampled_beat = beat
+                stacks.append((time.strftime("%H:%M:%S"), "".join(traceback.format_stack(frame)[-15:])))
+
+    async def capture(self, seconds: float) -> Path:
+        """在指定时间窗口内采集 cProfile、tracemalloc 与事件循环延迟，返回报告路径"""
+        if self.running:
+            raise RuntimeError("已有性能采集正在进行")
+        self.running = True
+
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        snapshot_before = tracemalloc.take_snapshot()
+
+        lag_events, stacks = [], []
+        heartbeat = [time.monotonic()]
+        stop = threading.Event()
+        monitor = asyncio.create_task(self._monitor_lag(lag_events, heartbeat))
+        sampler = threading.Thread(target=self._sample_blocked_stacks,
+                                   args=(threading.get_ident(), heartbeat, stacks, stop), daemon=True)
+        sampler.start()
+        profile = cProfile.Profile()
+        try:
+            # cProfile 作用于当前线程，即事件循环中运行的全部协程
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+            snapshot_after = tracemalloc.take_snapshot()
+        finally:
+            monitor.cancel()
+            stop.set()
+            if started_tracing:
+                tracemalloc.stop()
+            self.running = False
+
+        await asyncio.to_thread(sampler.join)
+        return await asyncio.to_thread(self._write_report, seconds, profile, lag_events, stacks,
+                                       snapshot_before, snapshot_after)
+
+    def _write_report(self, seconds: float, profile: cProfile.Profile, lag_events: list, stacks: list,
+                      snapshot_before: tracemalloc.Snapshot, snapshot_after: tracemalloc.Snapshot) -> Path:
+        self.report_dir.mkdir(parents=True, exist_ok=True)
+        name = f"profile_{time.strftime('%Y%m%d_%H%M%S')}"
+        # 原始数据可用 snakeviz 等工具查看
+        profile.dump_stats(str(self.report_dir / f"{name}.prof"))
+
+        out = io.StringIO()
+        out.write(f"采集时长: {seconds} 秒\n")
+        out.write(f"\n== 事件循环阻塞（阈值 {self.lag_threshold * 1000:.0f}ms）: {len(lag_events)} 次 ==\n")
+        for at, lag in lag_events:
+            out.write(f"{at}  {lag * 1000:.0f}ms\n")
+
+        out.write(f"\n== 阻塞时事件循环线程的调用栈: {len(stacks)} 次 ==\n")
+        for at, stack in stacks:
+            out.write(f"-- {at}\n{stack}\n")
+
+        for sort_key in ("cumulative", "tottime"):
+            out.write(f"\n== cProfile（按 {sort_key} 排序）==\n")
+            pstats.Stats(profile, stream=out).sort_stats(sort_key).print_stats(40)
+
+        out.write("\n== 内存分配增量（tracemalloc）==\n")
+        for stat in snapshot_after.compare_to(snapshot_before, "lineno")[:20]:
+            out.write(f"{stat}\n")
+
+        report_path = self.report_dir / f"{name}.txt"
+        with open(report_path, "w", encoding='utf-8') as f:
+            f.write(out.getvalue())
+        return report_path
@@ -0,0 +1,115 @@
+import math
+from typing import Optional
+from astrbot.api import logger
+
+
+class ResolutionPolicy:
+    # SDXL 训练时使用的常见宽高比分桶
+    ASPECT_BUCKETS = [
+        (1024, 1024),
+        (1152, 896), (896, 1152),
+        (1216, 832), (832, 1216),
+        (1344, 768), (768, 1344),
+        (1536, 640), (640, 1536),
+    ]
+    ALIGN = 64
+    # ComfyUI 潜空间图像允许的最大边长
+    MAX_SIDE = 16384
+
+    def __init__(self, max_pixels: int = 0, max_scale: float = 0, snap_buckets: bool = False,
+                 upscale_oversized: bool = False, group_limits: list = None):
+        self.max_pixels = max_pixels
+        self.max_scale = max_scale
+        self.snap_buckets = snap_buckets
+        self.upscale_oversized = upscale_oversized
+        self.group_limits = self.parse_group_limits(group_limits or [])
+
+    @staticmethod
+    def parse_group_limits(entries: list) -> dict:
+        """解析群组限制，格式为 群号:最大像素:最大超分倍率，留空的项使用全局设置"""
+        limits = {}
+        for entry in entries:
+            parts = [p.strip() for p in str(entry).split(':')]
+            if len(parts) != 3 or not parts[0]:
+                logger.error(f"[ComfyUI] 无法解析群组分辨率限制: {entry}")
+                continue
+            try:
+                max_pixels = int(parts[1]) if parts[1] else None
+                max_scale = float(parts[2]) if parts[2] else None
+            except ValueError:
+                logger.error(f"[ComfyUI] 无法解析群组分辨率限制: {entry}")
+                continue
+            limits[parts[0]] = (max_pixels, max_scale)
+        return limits
+
+    def limits_for(self, group_id: Optional[str]) -> tuple:
+        """获取群组的像素预算与超分倍率上限，0 表示不限制"""
+        max_pixels, max_scale = self.max_pixels, self.max_scale
+        if group_id and str(group_id) in self.group_limits:
+            group_pixels, group_scale = self.group_limits[str(group_id)]
+            if group_pixels is not None:
+                max_pixels = group_pixels
+            if group_scale is not None:
+                max_scale = group_scale
+        return max_pixels, max_scale
+
+    def _align(self, value: float) -> int:
+        return min(self.MAX_SIDE, max(self.ALIGN, int(round(value / self.ALIGN)) * self.ALIGN))
+
+    def _align_down(self, value: float) -> int:
+        return min(self.MAX_SIDE, max(self.ALIGN, int(value // self.ALIGN) * self.ALIGN))
+
+    def _fit_budget(self, width: int, height: int, max_pixels: int) -> tuple:
+        """等比缩小到像素预算以内；对齐后仍超出时（极端宽高比）继续缩短长边"""
+        factor = math.sqrt(max_pixels / (width * height))
+        width, height = self._align_down(width * factor), self._align_down(height * factor)
+        while width * height > max_pixels and max(width, height) > self.ALIGN:
+            if width >= height:
+                width -= self.ALIGN
+            else:
+                height -= self.ALIGN
+        return width, height
+
+    def _snap(self, width: int, height: int) -> tuple:
+        """吸附到最接近的宽高比分桶，保持面积不变"""
+        if not self.snap_buckets:
+            return self._align(width), self._align(height)
+
+        ratio = math.log(width / height)
+        bucket_w, bucket_h = min(self.ASPECT_BUCKETS, key=lambda b: abs(math.log(b[0] / b[1]) - ratio))
+        area = width * height
+        new_width = math.sqrt(area * bucket_w / bucket_h)
+        return self._align(new_width), self._align(area / new_width)
+
+    def apply(self, width: Optional[int], height: Optional[int], scale: Optional[float],
+              group_id: Optional[str] = None, can_upscale: bool = False) -> tuple:
+        """按策略调整分辨率与超分倍率，返回 (width, height, scale)"""
+        max_pixels, max_scale = self.limits_for(group_id)
+
+        # 非正数尺寸视为未指定，沿用工作流中的分辨率
+        if width is not None and width <= 0 or height is not None and height <= 0:
+            width, height = None, None
+
+        # 非正数倍率视为未指定，其余至少为 1 倍，避免超分节点收到无效值
+        if scale is not None:
+            scale = max(1.0, scale) if scale > 0 else None
+
+        if width and height:
+            width, height = self._snap(width, height)
+
+            if max_pixels and width * height > max_pixels:
+                new_width, new_height = self._fit_budget(width, height, max_pixels)
+
+                # 超出预算时改为先生成小图再超分，比直接生成大图更省显存
+                if self.upscale_oversized and can_upscale:
+                    # 按缩小最多的一边计算倍率，且放大后不超过最大边长
+                    ratio = max(width / new_width, height / new_height)
+                    ratio = min(ratio, self.MAX_SIDE / max(new_width, new_height))
+                    scale = round((scale or 1) * ratio, 2)
+
+                width, height = new_width, new_height
+
+        if scale is not None and max_scale and scale > max_scale:
+            scale = max_scale
+
+        return width, height, scale
@@ -1,15 +1,26 @@
+import asyncio
+import hashlib
 import json
+import math
 import random
+from io import BytesIO
 from typing import Optional
+from PIL import Image as PILImage
 from astrbot.api import logger
 from .comfyui_api import ComfyUIAPI
+from .resolution_policy import ResolutionPolicy
 
 
 class TextToImage:
+    WARMUP_SIZE = 64
+    WARMUP_IMAGE_KEY = "warmup"
+
     def __init__(self, api: ComfyUIAPI, workflow_path: str,
                  positive_node: str = "6", negative_node: str = "7",
                  resolution_node: str = "", width_field: str = "width", height_field: str = "height",
-                 upscale_node: str = "", scale_field: str = "resize_scale"):
+                 upscale_node: str = "", scale_field: str = "resize_scale",
+                 resolution_policy: ResolutionPolicy = None, websocket_output: bool = False,
+                 image_node: str = "", image_field: str = "image"):
         self.api = api
         self.workflow = self._load_workflow(workflow_path)
         self.positive_node = positive_node
@@ -19,6 +30,16 @@ class TextToImage:
         self.height_field = height_field
         self.upscale_node = upscale_node
         self.scale_field = scale_field
+        self.resolution_policy = resolution_policy or ResolutionPolicy()
+        self.websocket_output = websocket_output
+        self.image_node = image_node
+        self.image_field = image_field
+
+        # 由 /object_info 校验得出，未校验时为 None，回退到节点的第一个输入字段
+        self.positive_field = None
+        self.negative_field = None
+        self.validation_errors = []
+        self._validated_against = None
 
     @staticmethod
     def _load_workflow(path: str) -> dict:
@@ -27,12 +48,15 @@ class TextToImage:
             return json.load(f)
 
     @staticmethod
-    def _set_prompt(node: dict, prompt: str) -> bool:
-        """设置提示词到节点的第一个输入字段"""
+    def _set_prompt(node: dict, prompt: str, field: str = None) -> bool:
+        """设置提示词到指定字段，未指定时使用节点的第一个输入字段"""
         if not node or "inputs" not in node:
             return False
 
         inputs = node["inputs"]
+        if field:
+            inputs[field] = prompt
+            return True
         if not inputs:
             return False
 
@@ -40,23 +64,299 @@ class TextToImage:
         inputs[first_key] = prompt
         return True
 
+    @staticmethod
+    def _input_schema(node_info: dict) -> tuple:
+        """返回 (全部输入定义, 必填输入名)"""
+        input_info = node_info.get("input", {})
+        required = input_info.get("required", {}) or {}
+        schema = dict(required)
+        schema.update(input_info.get("optional", {}) or {})
+        return schema, set(required)
+
+    @staticmethod
+    def _find_text_field(schema: dict) -> Optional[str]:
+        """按类型查找文本输入字段，优先多行文本"""
+        fallback = None
+        for name, spec in schema.items():
+            if isinstance(spec, (list, tuple)) and spec and spec[0] == "STRING":
+                options = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+                if options.get("multiline"):
+                    return name
+                fallback = fallback or name
+        return fallback
+
+    def _check_workflow(self, object_info: dict) -> list:
+        """对照节点定义检查工作流与节点配置，返回错误信息列表"""
+        errors = []
+        schemas = {}
+        self.positive_field = None
+        self.negative_field = None
+        for node_id, node_data in self.workflow.items():
+            if not isinstance(node_data, dict):
+                continue
+            class_type = node_data.get("class_type")
+            if class_type not in object_info:
+                errors.append(f"节点 {node_id} 的类型 {class_type} 在 ComfyUI 中不存在")
+                continue
+            schema, required = self._input_schema(object_info[class_type])
+            schemas[node_id] = schema
+            missing = [name for name in required if name not in node_data.get("inputs", {})]
+            if missing:
+                errors.append(f"节点 {node_id} ({class_type}) 缺少必填输入: {', '.join(missing)}")
+
+        def check_node(node_id: str, label: str, fields: list) -> bool:
+            if node_id not in self.workflow:
+                errors.append(f"找不到{label}节点 {node_id}")
+                return False
+            if node_id not in schemas:
+                return False
+            class_type = self.workflow[node_id].get("class_type")
+            for field in fields:
+                if field not in schemas[node_id]:
+                    errors.append(f"{label}节点 {node_id} ({class_type}) 没有输入字段 {field}")
+            return True
+
+        if check_node(self.positive_node, "正面提示词", []):
+            self.positive_field = self._find_text_field(schemas[self.positive_node])
+            if not self.positive_field:
+                errors.append(f"正面提示词节点 {self.positive_node} 没有文本输入字段")
+        if self.negative_node in schemas:
+            self.negative_field = self._find_text_field(schemas[self.negative_node])
+        if self.resolution_node:
+            check_node(self.resolution_node, "分辨率", [self.width_field, self.height_field])
+        if self.upscale_node:
+            check_node(self.upscale_node, "超分", [self.scale_field])
+        if self.image_node:
+            check_node(self.image_node, "图片输入", [self.image_field])
+        if self.websocket_output and "SaveImageWebsocket" not in object_info:
+            errors.append("已开启 websocket 输出，但 ComfyUI 中没有 SaveImageWebsocket 节点")
+        return errors
+
+    def validate(self) -> list:
+        """使用缓存的 /object_info 校验工作流，返回错误信息列表；尚未获取到节点定义时不校验"""
+        object_info = self.api.object_info
+        if object_info is None or object_info is self._validated_against:
+            return self.validation_errors
+
+        self._validated_against = object_info
+        self.validation_errors = self._check_workflow(object_info)
+        for error in self.validation_errors:
+            logger.error(f"[ComfyUI] 工作流校验失败: {error}")
+        return self.validation_errors
+
+    @staticmethod
+    def _randomize_seeds(workflow: dict):
+        """随机化所有种子，同时避免 ComfyUI 命中缓存而跳过执行"""
+        base_seed = random.randint(1, 999999999999999)
+        offset = 0
+        for node_data in workflow.values():
+            if isinstance(node_data, dict):
+                inputs = node_data.get("inputs", {})
+                if "seed" in inputs:
+                    inputs["seed"] = base_seed + offset
+                    offset += 1
+                if "noise_seed" in inputs:
+                    inputs["noise_seed"] = base_seed + offset
+                    offset += 1
+
+    @staticmethod
+    def _use_websocket_outputs(workflow: dict) -> list:
+        """将 SaveImage 节点替换为 SaveImageWebsocket，返回全部 websocket 输出节点ID"""
+        output_nodes = []
+        for node_id, node_data in workflow.items():
+            if not isinstance(node_data, dict):
+                continue
+            if node_data.get("class_type") == "SaveImage":
+                node_data["class_type"] = "SaveImageWebsocket"
+                node_data["inputs"] = {"images": node_data.get("inputs", {}).get("images")}
+            # 工作流中原有的 SaveImageWebsocket 也视为输出；重试提交时工作流已被改写过，同样依赖这一点
+            if node_data.get("class_type") == "SaveImageWebsocket":
+                output_nodes.append(node_id)
+        return output_nodes
+
+    async def _queue(self, workflow: dict) -> tuple:
+        """提交任务，返回 (prompt_id, websocket 输出节点ID)"""
+        output_nodes = []
+        if self.websocket_output:
+            if await self.api.connect_ws():
+                output_nodes = self._use_websocket_outputs(workflow)
+            else:
+                logger.error("[ComfyUI] websocket 不可用，改用 HTTP 获取结果")
+        return await self.api.queue_prompt(workflow), output_nodes
+
+    async def _wait(self, prompt_id: str, output_nodes: list) -> Optional[bytes]:
+        if output_nodes:
+            return await self.api.wait_ws_result(prompt_id, output_nodes)
+        return await self.api.wait_result(prompt_id)
+
+    def _working_resolution(self, workflow: dict) -> Optional[tuple]:
+        """读取工作流实际使用的分辨率，用于决定输入图片的缩放尺寸"""
+        inputs, width_field, height_field = None, "width", "height"
+        if self.resolution_node and self.resolution_node in workflow:
+            inputs = workflow[self.resolution_node].get("inputs", {})
+            width_field, height_field = self.width_field, self.height_field
+        else:
+            for node_data in workflow.values():
+                if isinstance(node_data, dict) and node_data.get("class_type") == "EmptyLatentImage":
+                    inputs = node_data.get("inputs", {})
+                    break
+
+        if inputs:
+            width, height = inputs.get(width_field), inputs.get(height_field)
+            if isinstance(width, int) and isinstance(height, int):
+                return width, height
+        return None
+
+    @staticmethod
+    def _fit_image(image: bytes, size: Optional[tuple], max_pixels: int = 0) -> tuple:
+        """按工作分辨率（保持覆盖目标尺寸）与像素预算在本地缩小，返回 (图片数据, 扩展名)；无需缩小时原样返回"""
+        img = PILImage.open(BytesIO(image))
+        ratio = max(size[0] / img.width, size[1] / img.height) if size else 1
+        # 图生图工作流中输入图片的尺寸决定潜空间大小，因此同样受像素预算限制
+        budget_ratio = math.sqrt(max_pixels / (img.width * img.height)) if max_pixels else 1
+        if ratio >= 1 and budget_ratio >= 1:
+            return image, (img.format or "png").lower().replace("jpeg", "jpg")
+
+        if budget_ratio < ratio:
+            # 按预算缩放时对齐到 64 的倍数（向下取整，保证不超预算）
+            align = ResolutionPolicy.ALIGN
+            new_size = (max(align, int(img.width * budget_ratio) // align * align),
+                        max(align, int(img.height * budget_ratio) // align * align))
+        else:
+            new_size = (max(1, round(img.width * ratio)), max(1, round(img.height * ratio)))
+
+        fmt = img.format if img.format in ("JPEG", "PNG", "WEBP") else "PNG"
+        ext = fmt.lower().replace("jpeg", "jpg")
+
+        if img.mode not in ("RGB", "RGBA", "L"):
+            img = img.convert("RGB" if fmt == "JPEG" else "RGBA")
+        img = img.resize(new_size, PILImage.LANCZOS)
+        buffer = BytesIO()
+        img.save(buffer, format=fmt, quality=95)
+        return buffer.getvalue(), ext
+
+    async def _set_input_image(self, workflow: dict, image: bytes, group_id: str = None,
+                               use_cache: bool = True) -> tuple:
+        """上传输入图片并写入图片节点，返回 (缓存键, 是否命中缓存)，失败时缓存键为 None"""
+        size = self._working_resolution(workflow)
+        max_pixels = self.resolution_policy.limits_for(group_id)[0]
+        key = hashlib.sha256(image).hexdigest()[:16]
+        if size:
+            key += f"_{size[0]}x{size[1]}"
+        if max_pixels:
+            key += f"_p{max_pixels}"
+
+        name = self.api.get_cached_upload(key) if use_cache else None
+        cached = name is not None
+        if not cached:
+            try:
+                data, ext = await asyncio.to_thread(self._fit_image, image, size, max_pixels)
+            except Exception as e:
+                logger.error(f"[ComfyUI] 无法读取输入图片: {e}")
+                return None, False
+            name = await self.api.upload_image(data, key, ext)
+            if not name:
+                return None, False
+
+        workflow[self.image_node]["inputs"][self.image_field] = name
+        return key, cached
+
+    def build_warmup_workflow(self) -> dict:
+        """构建预热用的工作流：最少步数、最小分辨率，只为让模型加载进显存"""
+        workflow = json.loads(json.dumps(self.workflow))
+
+        pos_node = workflow.get(self.positive_node)
+        if pos_node:
+            self._set_prompt(pos_node, "warmup", self.positive_field)
+        neg_node = workflow.get(self.negative_node)
+        if neg_node:
+            self._set_prompt(neg_node, "", self.negative_field)
+
+        for node_id, node_data in workflow.items():
+            if not isinstance(node_data, dict):
+                continue
+            inputs = node_data.get("inputs", {})
+            if "steps" in inputs:
+                inputs["steps"] = 1
+            if node_data.get("class_type") == "EmptyLatentImage":
+                inputs["width"] = self.WARMUP_SIZE
+                inputs["height"] = self.WARMUP_SIZE
+            # 预热结果无需保留，PreviewImage 只写入 ComfyUI 的临时目录
+            if node_data.get("class_type") == "SaveImage":
+                node_data["class_type"] = "PreviewImage"
+                node_data["inputs"] = {"images": inputs.get("images")}
+
+        if self.resolution_node and self.resolution_node in workflow:
+            inputs = workflow[self.resolution_node]["inputs"]
+            inputs[self.width_field] = self.WARMUP_SIZE
+            inputs[self.height_field] = self.WARMUP_SIZE
+
+        if self.upscale_node and self.upscale_node in workflow:
+            workflow[self.upscale_node]["inputs"][self.scale_field] = 1
+
+        self._randomize_seeds(workflow)
+        return workflow
+
+    def _placeholder_image(self) -> bytes:
+        buffer = BytesIO()
+        PILImage.new("RGB", (self.WARMUP_SIZE, self.WARMUP_SIZE), (128, 128, 128)).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    async def warmup(self) -> bool:
+        """提交预热任务，返回是否成功"""
+        if self.validate():
+            return False
+
+        workflow = self.build_warmup_workflow()
+        if self.image_node and self.image_node in workflow:
+            # 图片输入工作流使用上传的占位图，而不是工作流中写死的文件名
+            name = self.api.get_cached_upload(self.WARMUP_IMAGE_KEY)
+            if not name:
+                name = await self.api.upload_image(self._placeholder_image(), self.WARMUP_IMAGE_KEY)
+            if not name:
+                logger.error("[ComfyUI] 预热占位图上传失败")
+                return False
+            workflow[self.image_node]["inputs"][self.image_field] = name
+
+        prompt_id = await self.api.queue_prompt(workflow)
+        if not prompt_id:
+            # 占位图可能已被服务端清理，下次预热时重新上传
+            self.api.forget_upload(self.WARMUP_IMAGE_KEY)
+            logger.error("[ComfyUI] 预热任务提交失败")
+            return False
+
+        # 只等待执行完成，不下载预热结果
+        if not await self.api.wait_done(prompt_id):
+            logger.error("[ComfyUI] 预热任务超时或失败")
+            return False
+        return True
+
     async def generate(self, prompt: str, negative: str = "bad hands", width: int = None, height: int = None,
-                       scale: float = None) -> Optional[bytes]:
+                       scale: float = None, group_id: str = None, image: bytes = None) -> Optional[bytes]:
         """生成图片"""
+        if self.validate():
+            return None
+
         workflow = json.loads(json.dumps(self.workflow))
 
+        can_upscale = bool(self.upscale_node) and self.upscale_node in workflow
+        requested = (width, height, scale)
+        width, height, scale = self.resolution_policy.apply(width, height, scale, group_id, can_upscale)
+        if (width, height, scale) != requested:
+            logger.info(f"[ComfyUI] 分辨率已按策略调整: {requested} -> {(width, height, scale)}")
+
         pos_node = workflow.get(self.positive_node)
         if not pos_node:
             logger.error(f"[ComfyUI] 找不到正面提示词节点 {self.positive_node}")
             return None
 
-        if not self._set_prompt(pos_node, prompt):
+        if not self._set_prompt(pos_node, prompt, self.positive_field):
             logger.error(f"[ComfyUI] 节点 {self.positive_node} 没有输入字段")
             return None
 
         neg_node = workflow.get(self.negative_node)
         if neg_node:
-            self._set_prompt(neg_node, negative)
+            self._set_prompt(neg_node, negative, self.negative_field)
 
         if width is not None and height is not None:
             if self.resolution_node:
@@ -74,24 +374,33 @@ class TextToImage:
             if self.upscale_node in workflow:
                 workflow[self.upscale_node]["inputs"][self.scale_field] = scale
 
-        base_seed = random.randint(1, 999999999999999)
-        offset = 0
-        for node_data in workflow.values():
-            if isinstance(node_data, dict):
-                inputs = node_data.get("inputs", {})
-                if "seed" in inputs:
-                    inputs["seed"] = base_seed + offset
-                    offset += 1
-                if "noise_seed" in inputs:
-                    inputs["noise_seed"] = base_seed + offset
-                    offset += 1
+        upload_key, upload_cached = None, False
+        if self.image_node and image is None:
+            logger.error("[ComfyUI] 工作流需要输入图片，但未提供")
+            return None
+        if image is not None:
+            if not self.image_node or self.image_node not in workflow:
+                logger.error(f"[ComfyUI] 找不到图片输入节点 {self.image_node}")
+                return None
+            upload_key, upload_cached = await self._set_input_image(workflow, image, group_id)
+            if not upload_key:
+                logger.error("[ComfyUI] 上传输入图片失败")
+                return None
 
-        prompt_id = await self.api.queue_prompt(workflow)
+        self._randomize_seeds(workflow)
+
+        prompt_id, output_nodes = await self._queue(workflow)
+        if not prompt_id and upload_cached:
+            # 服务端可能已清理缓存的图片，重新上传后再试一次
+            self.api.forget_upload(upload_key)
+            upload_key, _ = await self._set_input_image(workflow, image, group_id, use_cache=False)
+            if upload_key:
+                prompt_id, output_nodes = await self._queue(workflow)
         if not prompt_id:
             logger.error("[ComfyUI] 提交任务失败")
             return None
 
-        result = await self.api.wait_result(prompt_id)
+        result = await self._wait(prompt_id, output_nodes)
 
         if not result:
             logger.error("[ComfyUI] 等待结果超时或失败")